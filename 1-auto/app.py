@@ -1,15 +1,52 @@
 import pulumi
 from pulumi import automation as auto
 from pulumi_aws import s3
-from flask import Flask, request, make_response, jsonify
-from datetime import datetime
+from quart import Quart, request, make_response, jsonify
+from celery import Celery
+from cachetools import TTLCache
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import redis
 import boto3
 import botocore
+import botocore.config
+import asyncio
+import base64
+import fcntl
+import hashlib
+import importlib.metadata
+import json
 import os
+import pathlib
+import string
+import sys
+import tempfile
+import textwrap
+import threading
+import time
 
+# Provider plugin matching the installed pulumi_aws SDK, which is the version
+# the engine loads for `stack.up()`
+AWS_PLUGIN_VERSION = "v" + importlib.metadata.version("pulumi_aws")
+
+# The Docker image installs the plugin at build time; only fall back to
+# downloading it when running outside the image
 def ensure_plugins():
-    ws = auto.LocalWorkspace()
-    ws.install_plugin("aws", "v4.0.0")
+    pulumi_home = os.getenv("PULUMI_HOME", os.path.expanduser("~/.pulumi"))
+    if not os.path.isdir(os.path.join(pulumi_home, "plugins", f"resource-aws-{AWS_PLUGIN_VERSION}")):
+        ws = auto.LocalWorkspace()
+        ws.install_plugin("aws", AWS_PLUGIN_VERSION)
+
+# Shared AWS session and clients so calls reuse pooled keep-alive connections
+BOTO_CFG = botocore.config.Config(max_pool_connections=64,
+                                  retries={"max_attempts": 10, "mode": "adaptive"},
+                                  tcp_keepalive=True)
+SESSION = boto3.session.Session()
+STS = SESSION.client("sts", config=BOTO_CFG)
+
+# Seconds a successful credential check stays valid for other processes
+STS_CHECK_TTL = 300
 
 # Validate server environment credentials
 def ensure_aws_credentials():
@@ -21,50 +58,249 @@ def ensure_aws_credentials():
             f"Missing required AWS credentials: {', '.join(missing_vars)} ."
         )
 
-    try:
-        boto3.client('sts').get_caller_identity()
-    except botocore.exceptions.ClientError as e:
-        raise ValueError(
-            f"Invalid AWS credentials. Please ensure your AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY matches a valid AWS IAM user."
-            f"Error: {str(e)}"
-        )
-    except botocore.exceptions.NoCredentialsError:
-        raise ValueError(
-            "AWS credentials missing. Please set the AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment variables."
-        )
+    # Workers started together share one STS check: the first takes the lock and
+    # records success in a marker file that the others reuse until it goes stale
+    key_hash = hashlib.sha256(os.environ['AWS_ACCESS_KEY_ID'].encode()).hexdigest()[:16]
+    marker = pathlib.Path(tempfile.gettempdir()) / f"geostacks-sts-{key_hash}.ok"
+    with open(f"{marker}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if marker.exists() and time.time() - marker.stat().st_mtime < STS_CHECK_TTL:
+            return
+
+        try:
+            STS.get_caller_identity()
+        except botocore.exceptions.ClientError as e:
+            raise ValueError(
+                f"Invalid AWS credentials. Please ensure your AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY matches a valid AWS IAM user."
+                f"Error: {str(e)}"
+            )
+        except botocore.exceptions.NoCredentialsError:
+            raise ValueError(
+                "AWS credentials missing. Please set the AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment variables."
+            )
+        marker.touch()
 
 ensure_plugins()
 ensure_aws_credentials()
 
-app = Flask(__name__)
+app = Quart(__name__)
 PROJECT_NAME = "GeoStacks" # Fictional website builder/host
+REDIS_URL = os.environ["REDIS_URL"]
+
+# Shared workspace; the project settings never change, so build it once and
+# create/select every stack on it. Inline programs are passed to `stack.up()`
+# per call rather than stored on the workspace, and short calls that write to
+# its work_dir hold the lock.
+WORKSPACE = auto.LocalWorkspace(project_settings=auto.ProjectSettings(name=PROJECT_NAME, runtime="python"))
+workspace_lock = threading.Lock()
+# Max concurrent resource operations per up/destroy; raise until AWS starts throttling
+STACK_PARALLELISM = int(os.getenv("STACK_PARALLELISM", "32"))
+
+# Deployments run on a Celery worker (`celery -A app.celery worker`) so the
+# HTTP handlers return immediately instead of waiting on `stack.up()`.
+# The tasks don't touch the app context, so they run as plain Celery tasks.
+celery = Celery(app.import_name, broker=REDIS_URL)
+
+# Deployment status of each site, shared by the web app and the workers
+status_store = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+ACTIVE_STATUSES = ("pending", "running", "deleting")
+# Active statuses expire unless the task holding them keeps refreshing them, so
+# a task lost with its worker doesn't block the site forever
+ACTIVE_STATUS_TTL = 300
+
+def status_key(stack_name: str) -> str:
+    return f"{PROJECT_NAME}:status:{stack_name}"
+
+def get_status(stack_name: str) -> dict:
+    return status_store.hgetall(status_key(stack_name))
+
+def set_status(stack_name: str, status: str, **fields):
+    key = status_key(stack_name)
+    with status_store.pipeline() as pipe:
+        pipe.delete(key)
+        pipe.hset(key, mapping={"status": status, **fields})
+        if status in ACTIVE_STATUSES:
+            pipe.expire(key, ACTIVE_STATUS_TTL)
+        pipe.execute()
+
+# Atomically replaces a site's status unless it is currently one of `blocked`;
+# returns the blocking status, or None once the claim succeeds
+CLAIM_STATUS_SCRIPT = status_store.register_script("""
+local current = redis.call('HGET', KEYS[1], 'status')
+for i = 3, #ARGV do
+    if current == ARGV[i] then
+        return current
+    end
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'status', ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return false
+""")
+
+def claim_status(stack_name: str, status: str, blocked: tuple):
+    return CLAIM_STATUS_SCRIPT(keys=[status_key(stack_name)],
+                               args=[status, ACTIVE_STATUS_TTL, *blocked])
+
+# Keeps refreshing the expiry of a site's active status while a task works on it
+class StatusHeartbeat:
+    def __init__(self, stack_name: str):
+        self.key = status_key(stack_name)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.refresh_loop, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def refresh_loop(self):
+        while not self.stopped.wait(ACTIVE_STATUS_TTL / 5):
+            status_store.expire(self.key, ACTIVE_STATUS_TTL)
+
+# Collects Pulumi engine output and writes it to stdout in batches, so
+# concurrent deployments don't contend on the stdout lock for every line
+class BufferedSink:
+    def __init__(self, stack_name: str, interval: float = 0.05):
+        self.prefix = f"[{stack_name}] "
+        self.interval = interval
+        self.lines = deque()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.drain_loop, daemon=True)
+
+    def __call__(self, line: str):
+        self.lines.append(f"{self.prefix}{line}\n")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def drain(self):
+        batch = []
+        while self.lines:
+            batch.append(self.lines.popleft())
+        if batch:
+            sys.stdout.write("".join(batch))
+            sys.stdout.flush()
+
+    def drain_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.drain()
+        self.drain()
+
+# Short-lived cache for the read endpoints. Concurrent misses for the same key
+# share a single Pulumi CLI invocation: the first caller runs it while the
+# others wait on its in-flight event. Stacks change in the Celery workers, so
+# the TTL is the only bound on staleness; create and delete check the
+# workspace directly instead.
+read_cache = TTLCache(maxsize=1024, ttl=5)
+read_cache_lock = threading.Lock()
+in_flight: dict[str, threading.Event] = {}
+
+def cached_call(key: str, fn):
+    while True:
+        with read_cache_lock:
+            if key in read_cache:
+                return read_cache[key]
+            event = in_flight.get(key)
+            if event is None:
+                event = in_flight[key] = threading.Event()
+                break
+        # another request is already fetching this key; retry once it finishes
+        event.wait()
+
+    try:
+        result = fn()
+        with read_cache_lock:
+            read_cache[key] = result
+        return result
+    finally:
+        with read_cache_lock:
+            del in_flight[key]
+        event.set()
+
+def site_exists(stack_name: str) -> bool:
+    # uncached, since create and delete decide on it
+    with workspace_lock:
+        return any(stack.name == stack_name for stack in WORKSPACE.list_stacks())
+
+def list_site_ids() -> list:
+    def fetch():
+        with workspace_lock:
+            return [stack.name for stack in WORKSPACE.list_stacks()]
+    return cached_call("sites", fetch)
+
+def select_site_stack(stack_name: str) -> auto.Stack:
+    with workspace_lock:
+        return auto.Stack.select(stack_name, WORKSPACE)
+
+def get_site_url(stack_name: str) -> str:
+    def fetch():
+        return select_site_stack(stack_name).outputs()["website_url"].value
+    return cached_call(f"site:{stack_name}", fetch)
+
+# Starter image, inlined into index.html as a data URI so new sites don't
+# need a separate upload for it
+with open(os.path.join(os.path.dirname(__file__), "assets", "under-construction.gif"), "rb") as f:
+    CONSTRUCTION_GIF_URI = "data:image/gif;base64," + base64.b64encode(f.read()).decode()
+
+# HTML template for the starter index.html
+INDEX_TPL = string.Template(textwrap.dedent("""\
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>My GeoStacks Website</title>
+        <style>
+            body {
+                font-family: Arial, sans-serif;
+                text-align: center;
+                color: #0000ff;
+                background-color: #c0c0c0;
+            }
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <h1>Welcome to $name's Page</h1>
+            <img src="$construction_gif">
+            <p>Under construction</p>
+            <p>Created at: $timestamp</p>
+        </div>
+    </body>
+    </html>
+    """))
+
+# Bucket read policy, serialized once; only the bucket name varies per site
+POLICY_TPL = string.Template(json.dumps({
+    "Version": "2012-10-17",
+    "Statement": {
+        "Effect": "Allow",
+        "Principal": "*",
+        "Action": ["s3:GetObject"],
+        "Resource": ["arn:aws:s3:::${bucket}/*"]
+    },
+}))
+
+# Settings shared by every site created by the service
+@dataclass(frozen=True)
+class SiteConfig:
+    region: str = "us-west-2"
+
+DEFAULT_SITE_CONFIG = SiteConfig()
 
 # Helper that uploads starter assets for the static website
-def upload_starter_content(site_bucket: s3.BucketV2, name: str) -> s3.BucketWebsiteConfigurationV2:
-    # HTML content for index.html
-    content = """<!DOCTYPE html>
-        <html>
-        <head>
-            <title>My GeoStacks Website</title>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    text-align: center;
-                    color: #0000ff;
-                    background-color: #c0c0c0;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>Welcome to {name}'s Page</h1>
-                <img src="under-construction.gif">
-                <p>Under construction</p>
-                <p>Created at: {timestamp}</p>
-            </div>
-        </body>
-        </html>
-        """.format(timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), name=name)
+def upload_starter_content(site_bucket: s3.BucketV2, name: str,
+                           opts: pulumi.ResourceOptions) -> s3.BucketWebsiteConfigurationV2:
+    content = INDEX_TPL.substitute(name=name,
+                                   timestamp=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                                   construction_gif=CONSTRUCTION_GIF_URI)
 
     # Configure the website settings for the bucket
     website_configuration = s3.BucketWebsiteConfigurationV2("bucketConfig",
@@ -74,7 +310,8 @@ def upload_starter_content(site_bucket: s3.BucketV2, name: str) -> s3.BucketWebs
         ),
         error_document=s3.BucketWebsiteConfigurationV2ErrorDocumentArgs(
             key="error.html"
-        )
+        ),
+        opts=opts
     )
 
     # Upload index.html to the site bucket
@@ -82,18 +319,12 @@ def upload_starter_content(site_bucket: s3.BucketV2, name: str) -> s3.BucketWebs
                     bucket=site_bucket.id,
                     content=content,
                     key="index.html",
-                    content_type="text/html; charset=utf-8")
-
-    # Upload the image to the site bucket
-    s3.BucketObject("construction-img",
-                    bucket=site_bucket.id,
-                    source=pulumi.FileAsset('./assets/under-construction.gif'),
-                    key='under-construction.gif',
-    )
+                    content_type="text/html; charset=utf-8",
+                    opts=opts)
 
     return website_configuration
 
-def set_bucket_access(site_bucket: s3.BucketV2):
+def set_bucket_access(site_bucket: s3.BucketV2, opts: pulumi.ResourceOptions):
     # Configure the public access block settings to allow public policies
     bucket_public_access_block = s3.BucketPublicAccessBlock(
         "exampleBucketPublicAccessBlock",
@@ -102,98 +333,152 @@ def set_bucket_access(site_bucket: s3.BucketV2):
         ignore_public_acls=False,
         block_public_policy=False,
         restrict_public_buckets=False,
-        opts=pulumi.ResourceOptions(depends_on=[site_bucket])
+        opts=opts
     )
 
     # Set read access policy for the bucket
     s3.BucketPolicy("bucket-policy",
                     bucket=site_bucket.id,
-                    policy={
-                        "Version": "2012-10-17",
-                        "Statement": {
-                            "Effect": "Allow",
-                            "Principal": "*",
-                            "Action": ["s3:GetObject"],
-                            "Resource": [pulumi.Output.concat("arn:aws:s3:::", site_bucket.id, "/*")]
-                        },
-                    },
-                    opts=pulumi.ResourceOptions(depends_on=[bucket_public_access_block])
+                    policy=site_bucket.id.apply(lambda bucket: POLICY_TPL.substitute(bucket=bucket)),
+                    # S3 rejects public policies until the access block is relaxed
+                    opts=pulumi.ResourceOptions.merge(opts, pulumi.ResourceOptions(depends_on=[bucket_public_access_block]))
     )
     # Note: intentionally omitted versioning to keep the code concise
 
-# Create a static website on S3, customized by the passed parameter.
-def create_pulumi_program(name: str):
-    site_bucket = s3.BucketV2("s3-website-bucket")
+# A user's static website on S3, customized by the passed parameters.
+class GeoStacksSite(pulumi.ComponentResource):
+    def __init__(self, name: str, username: str, cfg: SiteConfig = DEFAULT_SITE_CONFIG,
+                 opts: pulumi.ResourceOptions = None):
+        super().__init__("geostacks:index:Site", name, None, opts)
+
+        # the alias keeps stacks created before the component from replacing their resources
+        child_opts = pulumi.ResourceOptions(parent=self,
+                                            aliases=[pulumi.Alias(parent=pulumi.ROOT_STACK_RESOURCE)])
+
+        site_bucket = s3.BucketV2("s3-website-bucket", opts=child_opts)
 
-    website_config = upload_starter_content(site_bucket, name)
+        # Register access settings first; apart from the policy waiting on the
+        # access block, these resources only depend on the bucket and deploy in parallel
+        set_bucket_access(site_bucket, child_opts)
 
-    set_bucket_access(site_bucket)
+        website_config = upload_starter_content(site_bucket, username, child_opts)
 
-    pulumi.export("website_url", website_config.website_endpoint)
+        self.website_url = website_config.website_endpoint
+        self.register_outputs({"website_url": self.website_url})
+
+def create_pulumi_program(name: str, cfg: SiteConfig = DEFAULT_SITE_CONFIG):
+    site = GeoStacksSite("site", name, cfg)
+    pulumi.export("website_url", site.website_url)
 
 @app.route("/sites", methods=["GET"])
-def list_handler():
+async def list_handler():
     """lists all sites"""
     try:
-        ws = auto.LocalWorkspace(project_settings=auto.ProjectSettings(name=PROJECT_NAME, runtime="python"))
-        stacks = ws.list_stacks()
-        return jsonify(ids=[stack.name for stack in stacks])
+        return jsonify(ids=await asyncio.to_thread(list_site_ids))
     except Exception as exn:
-        return make_response(str(exn), 500)
+        return await make_response(str(exn), 500)
 
-@app.route("/site", methods=["POST"])
-def create_handler():
-    name = request.json.get('username')
+@celery.task
+def deploy_stack(name: str, stack_name: str):
+    cfg = DEFAULT_SITE_CONFIG
 
     try:
         def pulumi_program():
-            return create_pulumi_program(name)
+            return create_pulumi_program(name, cfg)
         # create a new stack, generating our pulumi program on the fly from the POST body
-        stack = auto.create_stack(stack_name=name,
-                                  project_name=PROJECT_NAME,
-                                  program=pulumi_program)
-        stack.set_config("aws:region", auto.ConfigValue("us-west-2"))
+        with workspace_lock:
+            stack = auto.Stack.create(stack_name, WORKSPACE)
+            stack.set_config("aws:region", auto.ConfigValue(cfg.region))
+        set_status(stack_name, "running")
         # deploy the stack, tailing the logs to stdout
-        up_res = stack.up(on_output=print)
-        return jsonify(id=name, url=up_res.outputs['website_url'].value)
+        with BufferedSink(stack_name) as sink, StatusHeartbeat(stack_name):
+            # new stacks have nothing to refresh
+            up_res = stack.up(on_output=sink, parallel=STACK_PARALLELISM, refresh=False,
+                              program=pulumi_program)
+        set_status(stack_name, "done", url=up_res.outputs['website_url'].value)
     except auto.StackAlreadyExistsError:
-        return make_response(f"Stack '{name}' already exists", 409)
+        # created elsewhere after the handler checked; drop our pending claim so
+        # GET reports the existing stack's outputs
+        status_store.delete(status_key(stack_name))
+    except Exception as exn:
+        set_status(stack_name, "error", error=str(exn))
+        raise
+
+@app.route("/site", methods=["POST"])
+async def create_handler():
+    name = ((await request.get_json(silent=True)) or {}).get('username')
+    if not name:
+        return await make_response("Missing required field 'username'", 400)
+
+    try:
+        if await asyncio.to_thread(site_exists, name):
+            return await make_response(f"Stack '{name}' already exists", 409)
+        if await asyncio.to_thread(claim_status, name, "pending", ACTIVE_STATUSES):
+            return await make_response(f"Stack '{name}' already has update in progress", 409)
+        try:
+            await asyncio.to_thread(deploy_stack.delay, name, name)
+        except Exception:
+            await asyncio.to_thread(status_store.delete, status_key(name))
+            raise
+        return jsonify(id=name, status="pending"), 202
     except Exception as exn:
-        return make_response(str(exn), 500)
+        return await make_response(str(exn), 500)
 
 @app.route("/site/<string:id>", methods=["GET"])
-def get_handler(id: str):
+async def get_handler(id: str):
     stack_name = id
 
     try:
-        stack = auto.select_stack(stack_name=stack_name,
-                                  project_name=PROJECT_NAME,
-                                  # no-op program, just to get outputs
-                                  program=lambda *args: None)
-        outs = stack.outputs()
-        return jsonify(id=stack_name, url=outs["website_url"].value)
+        # report deployments queued on or running in a worker
+        status = await asyncio.to_thread(get_status, stack_name)
+        if status and status["status"] != "done":
+            return jsonify(id=stack_name, **status)
+        if status.get("url"):
+            return jsonify(id=stack_name, url=status["url"], status="done")
+
+        # the Pulumi CLI call runs on a thread so the event loop keeps serving requests
+        return jsonify(id=stack_name, url=await asyncio.to_thread(get_site_url, stack_name))
     except auto.StackNotFoundError:
-        return make_response(f"stack '{stack_name}' does not exist", 404)
+        return await make_response(f"stack '{stack_name}' does not exist", 404)
     except Exception as exn:
         print(exn)
-        return make_response(str(exn), 500)
+        return await make_response(str(exn), 500)
 
 # Omitted the update endpoint since updating S3 assets with the AWS S3 SDK makes more sense
 
-@app.route("/site/<string:id>", methods=["DELETE"])
-def delete_handler(id: str):
-    stack_name = id
+@celery.task
+def destroy_stack(stack_name: str):
     try:
-        stack = auto.select_stack(stack_name=stack_name,
-                                  project_name=PROJECT_NAME,
-                                  # noop program for destroy
-                                  program=lambda *args: None)
-        stack.destroy(on_output=print)
-        stack.workspace.remove_stack(stack_name)
-        return jsonify(message=f"Stack '{stack_name}' resources successfully removed!")
+        stack = select_site_stack(stack_name)
+        with BufferedSink(stack_name) as sink, StatusHeartbeat(stack_name):
+            stack.destroy(on_output=sink, parallel=STACK_PARALLELISM)
+        with workspace_lock:
+            WORKSPACE.remove_stack(stack_name)
+        set_status(stack_name, "deleted")
     except auto.StackNotFoundError:
-        return make_response(f"Stack '{stack_name}' does not exist", 404)
+        set_status(stack_name, "error", error=f"Stack '{stack_name}' does not exist")
     except auto.ConcurrentUpdateError:
-        return make_response(f"Stack '{stack_name}' already has update in progress", 409)
+        set_status(stack_name, "error", error=f"Stack '{stack_name}' already has update in progress")
+    except Exception as exn:
+        set_status(stack_name, "error", error=str(exn))
+        raise
+
+@app.route("/site/<string:id>", methods=["DELETE"])
+async def delete_handler(id: str):
+    stack_name = id
+    try:
+        status = (await asyncio.to_thread(get_status, stack_name)).get("status")
+        if status in ACTIVE_STATUSES:
+            return await make_response(f"Stack '{stack_name}' already has update in progress", 409)
+        if not await asyncio.to_thread(site_exists, stack_name):
+            return await make_response(f"Stack '{stack_name}' does not exist", 404)
+        if await asyncio.to_thread(claim_status, stack_name, "deleting", ACTIVE_STATUSES):
+            return await make_response(f"Stack '{stack_name}' already has update in progress", 409)
+        try:
+            await asyncio.to_thread(destroy_stack.delay, stack_name)
+        except Exception:
+            await asyncio.to_thread(status_store.delete, status_key(stack_name))
+            raise
+        return jsonify(id=stack_name, status="deleting"), 202
     except Exception as exn:
-        return make_response(str(exn), 500)
+        return await make_response(str(exn), 500)
@@ -3,17 +3,19 @@ import pulumi_aws as aws
 import pulumi_awsx as awsx
 import pulumi_eks as eks
 import pulumi_kubernetes as k8s
-import pulumi_docker as docker
 
 
 # Pre-requisite: upload the flask_app Docker image to ECR and replace the repo_name and image_name values
 
 repo_name = "ccho-aws/my-images"
-image_name = "682033509293.dkr.ecr.us-east-1.amazonaws.com/ccho-aws/my-images:latest"
+image_name = "682033509293.dkr.ecr.us-east-1.amazonaws.com/ccho-aws/my-images"
+image_tag = "latest"
 
-# Get ECR image
+# Get ECR image; the cluster nodes pull it directly, so it isn't pulled during `pulumi up`
 repo = awsx.ecr.Repository("ccho-aws/my-images")
-my_image = docker.RemoteImage("my-image", name=image_name) 
+
+# Reference the image by digest so every node pulls the same layers
+image_digest = aws.ecr.get_image(repository_name=repo_name, image_tag=image_tag).image_digest
 
 # Set up VPC
 my_vpc = awsx.ec2.Vpc("my_vpc",
@@ -37,13 +39,16 @@ cluster = eks.Cluster('my-cluster',
 )
 
 # Deploy app to Kubernetes
+config = pulumi.Config()
+replicas = config.get_int("replicas") or 2
+max_replicas = config.get_int("max_replicas") or 6
+
 app_labels = {"app": "pulumi-assignment-app"}
 deployment = k8s.apps.v1.Deployment("app-deployment",
     spec=k8s.apps.v1.DeploymentSpecArgs(
         selector=k8s.meta.v1.LabelSelectorArgs(
             match_labels=app_labels
         ),
-        replicas=1,
         template=k8s.core.v1.PodTemplateSpecArgs(
             metadata=k8s.meta.v1.ObjectMetaArgs(
                 labels=app_labels
@@ -51,7 +56,13 @@ deployment = k8s.apps.v1.Deployment("app-deployment",
             spec=k8s.core.v1.PodSpecArgs(
                 containers=[k8s.core.v1.ContainerArgs(
                     name="flask-app",
-                    image=my_image,
+                    image=f"{image_name}@{image_digest}",
+                    command=["gunicorn", "-k", "gevent", "-w", "2", "--worker-connections", "1000",
+                             "-b", "0.0.0.0:8080", "app:app"],
+                    # the autoscaler measures utilization against this request
+                    resources=k8s.core.v1.ResourceRequirementsArgs(
+                        requests={"cpu": "250m"}
+                    ),
                     ports=[k8s.core.v1.ContainerPortArgs(
                         container_port=8080
                     )]
@@ -61,4 +72,37 @@ deployment = k8s.apps.v1.Deployment("app-deployment",
     )
 )
 
+# The autoscaler reads pod CPU from metrics-server, which EKS doesn't install by default
+metrics_server = k8s.helm.v3.Release("metrics-server",
+    chart="metrics-server",
+    namespace="kube-system",
+    repository_opts=k8s.helm.v3.RepositoryOptsArgs(
+        repo="https://kubernetes-sigs.github.io/metrics-server/"
+    )
+)
+
+# Scale the app on CPU utilization; the autoscaler owns the replica count, so
+# the Deployment leaves spec.replicas unset
+hpa = k8s.autoscaling.v2.HorizontalPodAutoscaler("app-hpa",
+    spec=k8s.autoscaling.v2.HorizontalPodAutoscalerSpecArgs(
+        scale_target_ref=k8s.autoscaling.v2.CrossVersionObjectReferenceArgs(
+            api_version="apps/v1",
+            kind="Deployment",
+            name=deployment.metadata.name
+        ),
+        min_replicas=replicas,
+        max_replicas=max_replicas,
+        metrics=[k8s.autoscaling.v2.MetricSpecArgs(
+            type="Resource",
+            resource=k8s.autoscaling.v2.ResourceMetricSourceArgs(
+                name="cpu",
+                target=k8s.autoscaling.v2.MetricTargetArgs(
+                    type="Utilization",
+                    average_utilization=70
+                )
+            )
+        )]
+    )
+)
+
 pulumi.export('kubeconfig', cluster.kubeconfig)  # kubeconfig
@@ -1,11 +1,14 @@
 import os
-from flask import Flask
+from flask import Flask, Response
 app = Flask(__name__)
+app.url_map.strict_slashes = False
 
-@app.route("/")
+# The message is fixed for the life of the container, so build the body once
+_BODY = f"Your secret message is {os.environ.get('MY_MESSAGE') or ''}".encode()
+
+@app.route("/", methods=["GET"])
 def hello():
-    secret_msg = os.environ.get("MY_MESSAGE") or ""
-    return f"Your secret message is {secret_msg}"
+    return Response(_BODY, mimetype="text/plain")
 
 if __name__ == '__main__':
     app.run()
\ No newline at end of file